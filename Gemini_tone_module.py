@@ -1,8 +1,14 @@
 import json
-from constants import GEMINI_API_KEY
+import logging
+from constants import GEMINI_API_KEY, GEMINI_FALLBACK_MODEL, EVENT_LATENCY_BUDGET
 import google.generativeai as genai
 
 from find_comments_on_web import find_comments_of_the_place
+from latency_budget import Deadline, hedged_call
+from status_log import print_status
+
+# Below this many seconds left, skip the PTT comments and only ask Gemini
+COMMENTS_MIN_BUDGET = 8
 
 
 def load_prompt_from_txt(valid_tone) -> str:
@@ -18,6 +24,7 @@ def load_prompt_from_txt(valid_tone) -> str:
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel("gemini-2.5-flash")
 chat = model.start_chat()
+model_fallback = genai.GenerativeModel(GEMINI_FALLBACK_MODEL)
 
 # Load reply texts from json file
 with open("replies.json", "r", encoding="utf-8") as file:
@@ -26,25 +33,42 @@ with open("replies.json", "r", encoding="utf-8") as file:
     VALID_RESPONDS = list(REPLIES["VALID_RESPONDS"].keys())
 
 
-def generate_style_response(store_name: str, store_content: str, tone: str):
+def generate_style_response(store_name: str, store_content: str, tone: str, deadline: Deadline | None = None):
 
     """
     Load the corresponding prompt based on the user-selected tone, and send the request to Gemini.
+    When the deadline is short, the review is generated without PTT comments.
 
     """
+    if deadline is None:
+        deadline = Deadline(EVENT_LATENCY_BUDGET)
+
     if tone not in VALID_TONES:
         return f"⚠️ Unable to find the prompt for '{tone}' style. Please choose another tone."
 
     # load prompt from txt
     tone_prompt = load_prompt_from_txt(tone)
-    print(tone_prompt)
+    print_status(tone_prompt, level=logging.DEBUG)
+
+    # PTT comments may use at most half of the remaining time, Gemini needs the rest
+    if deadline.remaining() >= COMMENTS_MIN_BUDGET:
+        comments = find_comments_of_the_place(store_name, deadline=deadline.portion(0.5))
+    else:
+        print_status("⏱️ Not enough time left, generating the review without PTT comments")
+        comments = []
 
     prompt = (tone_prompt + f"\n\nIntroduce this restaurant: {store_content}" +
-              f"Here are some reviews found online that you may refer to: {find_comments_of_the_place(store_name)}" +
+              f"Here are some reviews found online that you may refer to: {comments}" +
               load_prompt_from_txt("COMMON_PROMPT"))
-    response = chat.send_message(prompt)
 
-    return response.text.strip()
+    reply = hedged_call(
+        primary=lambda timeout: chat.send_message(prompt, request_options={"timeout": timeout}).text,
+        fallback=lambda timeout: model_fallback.generate_content(prompt, request_options={"timeout": timeout}).text,
+        deadline=deadline,
+        stage="generate_style_response",
+    )
+
+    return reply.strip()
 
 
 # 測試
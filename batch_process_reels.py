@@ -0,0 +1,233 @@
+"""
+Bulk offline reel processing.
+
+Runs reel captions from a JSONL file through the same analysis used by the webhook
+(is_food_related -> fetch_location_candidates_from_gemini -> generate_style_response)
+without the Messenger round trip. Useful for warming up before a marketing push and
+for regression-testing prompt changes.
+
+Input: one JSON object per line, e.g. {"id": "reel-1", "caption": "..."}
+       ("reels_content" or "title" are accepted instead of "caption", id defaults to the line number)
+Output: one JSON result per line, written as soon as each caption finishes.
+        Captions whose id is already in the output file without an error are skipped, so an interrupted run
+        can be resumed and failed captions are retried (the last line written for an id is the current one).
+
+Example:
+    python batch_process_reels.py captions.jsonl results.jsonl --workers 8 --tone ASK_TO_USE_MEME_TONE --timeout 60
+    python batch_process_reels.py captions.jsonl results.jsonl --offline
+"""
+import argparse
+import json
+import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from typing import Dict, List
+
+import main
+import Gemini_tone_module
+
+from latency_budget import Deadline, set_hedge_pool_size
+from status_log import print_status
+
+BATCH_CAPTION_TIMEOUT = 120  # Seconds per caption, there is no webhook reply waiting on a batch run
+FOOD_KEYWORDS = ["food", "eat", "restaurant", "cafe", "吃", "美食", "餐廳", "火鍋", "小吃", "甜點", "咖啡", "拉麵", "鍋"]
+
+
+# ---------------------------------
+# Local stand-ins (--offline)
+
+class OfflineModel:
+    """Local stand-in for genai.GenerativeModel, answers from the caption inside the prompt."""
+
+    def generate_content(self, prompt: str, **kwargs) -> SimpleNamespace:
+        caption = prompt.split("Below is the text:")[-1].strip()
+
+        if "classifier" in prompt:
+            is_food = any(keyword in caption.lower() for keyword in FOOD_KEYWORDS)
+            return SimpleNamespace(text="Yes" if is_food else "No")
+
+        # Treat hashtags as store names, in the order they appear
+        names = list(dict.fromkeys(re.findall(r"#(\w+)", caption)))[:main.MAX_STORE_CANDIDATES]
+        if not names:
+            return SimpleNamespace(text="NO_STORE_FOUND")
+        return SimpleNamespace(text="\n".join(f"【Name】: {name}\n【Address】: Unknown" for name in names))
+
+
+class OfflineChat:
+    """Local stand-in for the Gemini chat used by generate_style_response."""
+
+    def send_message(self, prompt: str, **kwargs) -> SimpleNamespace:
+        return SimpleNamespace(text=f"[offline] styled reply ({len(prompt)} prompt chars)")
+
+
+class StatelessChat:
+    """Sends every prompt on its own, so a batch run does not pile everything into one chat history."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def send_message(self, prompt: str, **kwargs):
+        return self.model.generate_content(prompt, **kwargs)
+
+
+def use_offline_stand_ins() -> None:
+    main.model_location = main.model_fallback = OfflineModel()
+    Gemini_tone_module.model_fallback = OfflineModel()
+    Gemini_tone_module.chat = OfflineChat()
+    Gemini_tone_module.find_comments_of_the_place = lambda name, deadline=None: []
+
+
+# ---------------------------------
+# Per-stage throughput
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.busy_seconds += seconds
+
+    def report(self, wall_seconds: float) -> str:
+        if self.count == 0:
+            return f"{self.name:<10} 0 items"
+        return (f"{self.name:<10} {self.count} items, "
+                f"{self.count / wall_seconds:.2f} items/s, "
+                f"{self.busy_seconds / self.count * 1000:.0f} ms avg")
+
+
+STAGES = {name: StageStats(name) for name in ["food", "location", "style"]}
+
+
+def timed(stage: str, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        STAGES[stage].record(time.perf_counter() - start)
+
+
+# ---------------------------------
+# Batch processing
+
+def read_captions(input_path: str) -> List[Dict[str, str]]:
+    captions = []
+    with open(input_path, "r", encoding="utf-8") as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            caption = item.get("caption") or item.get("reels_content") or item.get("title") or ""
+            captions.append({"id": str(item.get("id", line_number)), "caption": caption})
+    return captions
+
+
+def read_done_ids(output_path: str) -> set:
+    """Ids already written to the output file without an error (used to resume, failed ids are retried)."""
+    done_ids = set()
+    try:
+        with open(output_path, "r", encoding="utf-8") as output_file:
+            for line in output_file:
+                try:
+                    result = json.loads(line)
+                    result_id = str(result["id"])
+                except (json.JSONDecodeError, KeyError):
+                    continue  # Half-written line from an interrupted run
+
+                if result.get("error") is None:
+                    done_ids.add(result_id)
+                else:
+                    done_ids.discard(result_id)  # A later failed retry overrides an earlier result
+    except FileNotFoundError:
+        pass
+    return done_ids
+
+
+def process_caption(item: Dict[str, str], tone: str | None, timeout: float) -> dict:
+    """
+        Runs one caption through all stages.
+        Every stage gets the caption's own deadline, not the webhook's EVENT_LATENCY_BUDGET default.
+    """
+    result = {"id": item["id"], "caption": item["caption"], "is_food_related": None,
+              "store_candidates": [], "store_name": "NO", "styled_reply": None, "error": None}
+    deadline = Deadline(timeout)
+    try:
+        result["is_food_related"] = timed("food", main.is_food_related, item["caption"], deadline=deadline)
+        if not result["is_food_related"]:
+            return result
+
+        candidates = timed("location", main.fetch_location_candidates_from_gemini, item["caption"],
+                           deadline=deadline)
+        result["store_candidates"] = candidates
+        if not candidates:
+            return result
+        result["store_name"] = candidates[0]["name"]
+
+        if tone is not None:
+            result["styled_reply"] = timed("style", Gemini_tone_module.generate_style_response,
+                                           result["store_name"], item["caption"], tone, deadline=deadline)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def run_batch(input_path: str, output_path: str, workers: int, tone: str | None,
+              timeout: float = BATCH_CAPTION_TIMEOUT) -> None:
+    captions = read_captions(input_path)
+    done_ids = read_done_ids(output_path)
+    pending = [item for item in captions if item["id"] not in done_ids]
+    print_status(f"📦 {len(captions)} captions, {len(captions) - len(pending)} already done, {len(pending)} to process")
+
+    # Every worker can have a primary and a hedge Gemini call running at the same time
+    set_hedge_pool_size(2 * workers)
+
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output_file, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_caption, item, tone, timeout) for item in pending]
+        try:
+            for finished, future in enumerate(as_completed(futures), start=1):
+                output_file.write(json.dumps(future.result(), ensure_ascii=False) + "\n")
+                output_file.flush()
+                if finished % 50 == 0:
+                    print_status(f"... {finished}/{len(pending)}")
+        except KeyboardInterrupt:
+            print_status("⚠️ Interrupted, finished results are saved. Run again to resume.")
+            for future in futures:
+                future.cancel()
+            raise
+
+    wall_seconds = max(time.perf_counter() - start, 1e-9)
+    print_status(f"✅ Done in {wall_seconds:.1f}s")
+    for stats in STAGES.values():
+        print_status(stats.report(wall_seconds))
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Process reel captions from a JSONL file in bulk.")
+    parser.add_argument("input", help="JSONL file with one caption per line")
+    parser.add_argument("output", help="JSONL file to append results to (also used to resume)")
+    parser.add_argument("--workers", type=int, default=4, help="number of captions processed in parallel")
+    parser.add_argument("--tone", choices=main.VALID_TONES, default=None,
+                        help="also run generate_style_response with this tone")
+    parser.add_argument("--timeout", type=float, default=BATCH_CAPTION_TIMEOUT,
+                        help="seconds allowed per caption, across all of its stages")
+    parser.add_argument("--offline", action="store_true", help="use local stand-ins instead of Gemini / PTT")
+    args = parser.parse_args()
+
+    if args.offline:
+        use_offline_stand_ins()
+    else:
+        Gemini_tone_module.chat = StatelessChat(Gemini_tone_module.model)
+
+    run_batch(args.input, args.output, args.workers, args.tone, args.timeout)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,94 @@
+"""
+Microbenchmark of the cost per webhook event in main.py's message hot path.
+
+Gemini answers instantly from a local stand-in model (still through ask_gemini -> hedged_call and its thread pool)
+and the Graph API is replaced by a no-op, so only our own work is measured
+(prompt building, the hedging pool, reply parsing, quick-reply payloads, status logging).
+CPU time is measured for the whole process after the status log queue is drained, so work handed to other threads
+is included. Wall time is the request thread's own time, before the queued log lines are written.
+
+Example:
+    python benchmark_hot_path.py --events 5000 > /dev/null
+    python benchmark_hot_path.py --events 500 --slow-stdout 2 > /dev/null  # stdout that takes 2 ms per write
+"""
+import argparse
+import sys
+import time
+
+from types import SimpleNamespace
+
+import main
+import status_log
+
+CAPTION = "今天去了台北信義區的鼎泰豐，小籠包超好吃！ #鼎泰豐 #DinTaiFung #台北美食 " * 3
+USER_ID = "benchmark-user"
+GEMINI_REPLY = ("【Name】: Din Tai Fung (Xinyi District)\n【Address】: Xinyi District, Taipei City\n"
+                "【Name】: Din Tai Fung (Taipei 101)\n【Address】: Unknown")
+
+
+class InstantModel:
+    """Stand-in for genai.GenerativeModel that answers at once."""
+
+    def generate_content(self, prompt: str, **kwargs) -> SimpleNamespace:
+        return SimpleNamespace(text=GEMINI_REPLY)
+
+
+class SlowStream:
+    """Stand-in for a stdout that blocks on every write (a full pipe, a stalled log collector)."""
+
+    def __init__(self, stream, delay: float):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+def drain_status_log() -> None:
+    status_log.listener.stop()  # Writes out everything queued so far
+    status_log.listener.start()
+
+
+def bench(name: str, func, events: int) -> float:
+    func()  # Warm up
+    drain_status_log()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(events):
+        func()
+    wall_per_event = (time.perf_counter() - wall_start) / events * 1e6
+    drain_status_log()
+    cpu_per_event = (time.process_time() - cpu_start) / events * 1e6
+    print(f"{name:<16} {cpu_per_event:8.1f} µs/event CPU {wall_per_event:10.1f} µs/event wall", file=sys.stderr)
+    return cpu_per_event
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Measure the cost per event of the message hot path.")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--slow-stdout", type=float, default=0, metavar="MS",
+                        help="make every write to stdout take this many milliseconds")
+    args = parser.parse_args()
+
+    main.model_location = main.model_fallback = InstantModel()
+    main.requests = SimpleNamespace(post=lambda *a, **k: None, RequestException=Exception)
+    if args.slow_stdout:
+        status_log.stdout_handler.setStream(SlowStream(sys.stdout, args.slow_stdout / 1000))
+    main.create_or_update_user_and_reel(USER_ID, CAPTION)
+
+    stages = {
+        "location": lambda: main.fetch_location_candidates_from_gemini(CAPTION),
+        "quick_reply": lambda: main.send_ig_quick_reply(USER_ID, "📍 Name: ...", ["YES", "NO", "WANT_TO_END_DIALOG"]),
+        "change_tone": lambda: main.let_user_change_tone(USER_ID),
+        "status": lambda: main.print_status(user_id=USER_ID, line="✅ User-selected tone"),
+    }
+    total = sum(bench(name, func, args.events) for name, func in stages.items())
+    print(f"{'total':<16} {total:8.1f} µs/event CPU", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,3 +3,23 @@ import os
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
 PAGE_ACCESS_TOKEN = os.getenv("PAGE_ACCESS_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+# Latency budget of one webhook event (Meta expects an answer within ~20 seconds)
+EVENT_LATENCY_BUDGET = float(os.getenv("EVENT_LATENCY_BUDGET", "18"))
+# Gemini calls slower than this percentile of recent calls are hedged with the fallback model
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_AFTER = float(os.getenv("HEDGE_DEFAULT_AFTER", "6"))
+GEMINI_FALLBACK_MODEL = os.getenv("GEMINI_FALLBACK_MODEL", "gemini-2.5-flash-lite")
+PTT_REQUEST_TIMEOUT = 5
+GRAPH_API_TIMEOUT = 10
+GRAPH_API_MIN_TIMEOUT = 2  # Even with the budget used up, the reply to the user still gets this long
+
+# Status log (status_log.py), DEBUG also logs the full prompts; the latency summary is logged every N replies
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LATENCY_SUMMARY_EVERY = int(os.getenv("LATENCY_SUMMARY_EVERY", "50"))
+
+# Opt-in profiling endpoints (/debug/*), see profiling.py
+ENABLE_PROFILING = os.getenv("ENABLE_PROFILING", "") == "1"
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")  # Required, the /debug/* routes stay off without it
+PROFILE_DUMP_DIR = os.getenv("PROFILE_DUMP_DIR", "profiles")
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "1"))
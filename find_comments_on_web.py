@@ -1,16 +1,26 @@
+import logging
 import requests
 from bs4 import BeautifulSoup
 from typing import List
 
+from constants import PTT_REQUEST_TIMEOUT
+from latency_budget import Deadline
+from status_log import print_status
 
-def find_comments_of_the_place(name: str) -> List[str]:
+
+def find_comments_of_the_place(name: str, deadline: Deadline | None = None) -> List[str]:
     """
         Fetches comments (replies) from PTT Food board about a given food place.
+        Stops early and returns the comments found so far when the deadline runs out.
 
         :param name: The name of the place (food shop) we want to find.
+        :param deadline: latency budget for the whole search (no limit except per-request timeouts if None)
         :return: A list of comments found on the web.
     """
 
+    def request_timeout() -> float:
+        return PTT_REQUEST_TIMEOUT if deadline is None else max(0.1, deadline.timeout(PTT_REQUEST_TIMEOUT))
+
     url = f'https://www.ptt.cc/bbs/Food/search?q={name}'
     headers = {
         'User-Agent': 'Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) '
@@ -18,20 +28,24 @@ def find_comments_of_the_place(name: str) -> List[str]:
     }
 
     try:
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, timeout=request_timeout())
         response.raise_for_status()  # Raise an error for bad responses
-        print(f"✅ Get the page successfully ...")
+        print_status("✅ Get the page successfully ...")
     except requests.RequestException as e:
-        print(f"❌ 無法獲取頁面: {e}")
+        print_status(f"❌ 無法獲取頁面: {e}", level=logging.WARNING)
         return []
 
-    print(f"Fetching Comments for {name} ...")
+    print_status(f"Fetching Comments for {name} ...")
     soup = BeautifulSoup(response.text, 'html.parser')
     articles = soup.find_all('div', class_='r-ent')
 
     comments_list = []
 
     for article in articles:
+        if deadline is not None and deadline.expired():
+            print_status(f"⏱️ Time is up, using {len(comments_list)} comments found so far")
+            break
+
         title_element = article.find("div", class_="title")
         if not title_element or not title_element.a:
             continue  # Skip if there's no valid article
@@ -39,7 +53,7 @@ def find_comments_of_the_place(name: str) -> List[str]:
         post_url = f"https://www.ptt.cc{title_element.a['href']}"
 
         try:
-            post_response = requests.get(post_url, headers=headers)
+            post_response = requests.get(post_url, headers=headers, timeout=request_timeout())
             post_response.raise_for_status()
         except requests.RequestException:
             continue  # Skip this article if we fail to fetch comments
@@ -53,7 +67,7 @@ def find_comments_of_the_place(name: str) -> List[str]:
                 comment_text = push_content.text.strip()[1:]  # Remove leading colon ":"
                 comments_list.append(comment_text)
 
-    print("\n".join(comments_list) if comments_list else "⚠️ 沒有找到評論")
+    print_status("\n".join(comments_list) if comments_list else "⚠️ 沒有找到評論", level=logging.DEBUG)
     return comments_list
 
 
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, List
+
+from status_log import print_status
+from constants import HEDGE_PERCENTILE, HEDGE_DEFAULT_AFTER
+
+
+class BudgetExceeded(Exception):
+    """Raised when a stage has no latency budget left."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Latency budget exceeded at '{stage}'")
+        self.stage = stage
+
+
+class GeminiUnavailable(Exception):
+    """Raised when both the primary and the fallback model failed while budget was still left."""
+
+    def __init__(self, stage: str, error: BaseException):
+        super().__init__(f"Gemini unavailable at '{stage}': {error}")
+        self.stage = stage
+
+
+class Deadline:
+    """
+        Latency budget of one webhook event.
+        Every stage checks it and passes it (or a part of it) down to the next stage.
+    """
+
+    def __init__(self, seconds: float):
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: float) -> float:
+        """Timeout for a single external call: the remaining budget, but never more than cap."""
+        return min(self.remaining(), cap)
+
+    def check(self, stage: str) -> None:
+        if self.expired():
+            raise BudgetExceeded(stage)
+
+    def portion(self, fraction: float) -> "Deadline":
+        """A shorter deadline for an optional stage, so it cannot use up the whole budget."""
+        return Deadline(self.remaining() * fraction)
+
+
+def percentile(values: List[float], pct: float, is_sorted: bool = False) -> float:
+    ordered = values if is_sorted else sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class LatencyStats:
+    """Time to reply and Gemini hedge rates, shared by all requests."""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        # Each stage has its own latency history: a long review call must not be hedged against short classifier calls
+        self.gemini_latencies = defaultdict(lambda: deque(maxlen=window))
+        self.reply_times = deque(maxlen=window)
+        self.replies = 0
+        self.gemini_calls = 0
+        self.hedged_calls = 0
+        self.fallback_wins = 0
+        self.budget_exceeded = 0
+
+    def hedge_after(self, stage: str) -> float:
+        """Seconds to wait for the primary model of this stage before sending a hedge request."""
+        with self._lock:
+            latencies = self.gemini_latencies.get(stage, ())
+            if len(latencies) < 20:
+                return HEDGE_DEFAULT_AFTER
+            return percentile(list(latencies), HEDGE_PERCENTILE)
+
+    def record_gemini(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.gemini_latencies[stage].append(seconds)
+
+    def record_call(self, hedged: bool, fallback_won: bool) -> None:
+        with self._lock:
+            self.gemini_calls += 1
+            self.hedged_calls += hedged
+            self.fallback_wins += fallback_won
+
+    def record_reply(self, seconds: float, budget_exceeded: bool = False) -> int:
+        """Returns the number of replies recorded so far."""
+        with self._lock:
+            self.reply_times.append(seconds)
+            self.budget_exceeded += budget_exceeded
+            self.replies += 1
+            return self.replies
+
+    def summary(self) -> str:
+        with self._lock:
+            reply_times = sorted(self.reply_times)
+            hedge_rate = self.hedged_calls / self.gemini_calls if self.gemini_calls else 0.0
+            text = (f"⏱️ Gemini calls: {self.gemini_calls}, hedged: {hedge_rate:.0%}, "
+                    f"fallback wins: {self.fallback_wins}, budget exceeded: {self.budget_exceeded}")
+        if reply_times:
+            text += (f", time to reply p50: {percentile(reply_times, 50, is_sorted=True):.2f}s"
+                     f" p95: {percentile(reply_times, 95, is_sorted=True):.2f}s")
+        return text
+
+
+LATENCY_STATS = LatencyStats()
+HEDGE_POOL_SIZE = 16
+_executor = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="gemini")
+
+
+def set_hedge_pool_size(max_workers: int) -> None:
+    """
+        Grows the thread pool behind hedged_call (it never shrinks).
+        Each hedged call can hold two threads (primary + hedge), so callers running N calls in parallel need 2 * N.
+    """
+    global _executor, HEDGE_POOL_SIZE
+
+    if max_workers <= HEDGE_POOL_SIZE:
+        return
+    old_executor = _executor
+    HEDGE_POOL_SIZE = max_workers
+    _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini")
+    old_executor.shutdown(wait=False)  # Calls already submitted still finish
+
+
+def hedged_call(primary: Callable[[float], str], fallback: Callable[[float], str], deadline: Deadline, stage: str) -> str:
+    """
+        Calls primary, and sends the same request to fallback (a faster model) when primary is slower
+        than the recent latency percentile or fails. The first successful answer wins.
+
+        :param primary: function(timeout_seconds) -> text, the normal Gemini call
+        :param fallback: function(timeout_seconds) -> text, the hedge / fallback call
+        :param deadline: latency budget of the current event
+        :param stage: name of the call, used for its own latency history, in logs and in BudgetExceeded
+
+        :return: text of the first successful answer
+        :raises GeminiUnavailable: both calls failed
+        :raises BudgetExceeded: no answer within the deadline
+    """
+    deadline.check(stage)
+    start = time.monotonic()
+
+    def record_primary_latency(future) -> None:
+        if future.exception() is None:
+            LATENCY_STATS.record_gemini(stage, time.monotonic() - start)
+
+    first = _executor.submit(primary, deadline.remaining())
+    first.add_done_callback(record_primary_latency)
+    hedge = None
+    pending = {first}
+    error = None
+
+    wait(pending, timeout=min(LATENCY_STATS.hedge_after(stage), deadline.remaining()))
+    while pending:
+        # Primary is slow or failed -> send the hedge request (once)
+        if hedge is None and not deadline.expired() and (not first.done() or first.exception() is not None):
+            print_status(f"🔀 Hedging '{stage}' with the fallback model...")
+            hedge = _executor.submit(fallback, deadline.remaining())
+            pending.add(hedge)
+
+        done, pending = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            break  # Budget ran out while waiting
+
+        for future in done:
+            if future.exception() is None:
+                LATENCY_STATS.record_call(hedged=hedge is not None, fallback_won=future is hedge)
+                return future.result()
+            error = future.exception()
+            print_status(f"⚠️ Gemini call for '{stage}' failed: {error}", level=logging.WARNING)
+
+    LATENCY_STATS.record_call(hedged=hedge is not None, fallback_won=False)
+    if error is not None and not deadline.expired():
+        raise GeminiUnavailable(stage, error) from error
+    raise BudgetExceeded(stage)
@@ -2,16 +2,22 @@
 import requests
 import google.generativeai as genai
 import json
+import logging
 import time
 import threading
 import re
 
 from flask import Flask, request
+import Gemini_tone_module
 from Gemini_tone_module import generate_style_response
-from dataclasses import dataclass, asdict
-from typing import Dict
+from dataclasses import dataclass, asdict, field
+from typing import Dict, List
 
-from constants import VERIFY_TOKEN, PAGE_ACCESS_TOKEN, GEMINI_API_KEY
+from status_log import print_status
+from latency_budget import Deadline, BudgetExceeded, GeminiUnavailable, hedged_call, LATENCY_STATS
+from profiling import EVENT_PROFILER, register_profiling_routes
+from constants import (VERIFY_TOKEN, PAGE_ACCESS_TOKEN, GEMINI_API_KEY, GEMINI_FALLBACK_MODEL, EVENT_LATENCY_BUDGET,
+                       GRAPH_API_TIMEOUT, GRAPH_API_MIN_TIMEOUT, LATENCY_SUMMARY_EVERY)
 
 # Load reply texts from json file
 with open("replies.json", "r", encoding="utf-8") as file:
@@ -29,16 +35,43 @@ def get_reply(msg_dict_key: str) -> str:
         return REPLIES["VALID_RESPONDS"][msg_dict_key]
 
     else:
-        error_msg = f"⚠️ ERROR: '{msg_dict_key}' not found in replies.json!"
-        print(error_msg)  # Directly print error message
+        print_status(line=f"⚠️ ERROR: '{msg_dict_key}' not found in replies.json!")
         return "❓ Unknown message type."
 
 
+# Built once: Graph API endpoint and quick-reply option payloads
+GRAPH_API_URL = f"https://graph.facebook.com/v21.0/me/messages?access_token={PAGE_ACCESS_TOKEN}"
+GRAPH_API_HEADERS = {"Content-Type": "application/json"}
+
+
+def build_quick_reply_option(option: str) -> Dict[str, str]:
+    return {"content_type": "text", "title": get_reply(option), "payload": option}
+
+
+QUICK_REPLY_OPTIONS = {option: build_quick_reply_option(option) for option in VALID_TONES + VALID_RESPONDS}
+TONE_OPTIONS = VALID_TONES + ["WANT_TO_END_DIALOG"]
+CHANGE_TONE_MESSAGE = ("Which tone would you like me to use in future replies 🤖? \n\nPlease choose:"
+                       + "、".join(map(get_reply, VALID_TONES)))
+CHANGE_TONE_HINT = f"📢 If you want to adjust the tone, please click 【{get_reply('WANT_TO_CHANGE_TONE')}】! 😊"
+END_DIALOG_HINT = f"⚠️ If you want to end the conversation, you can click 【{get_reply('WANT_TO_END_DIALOG')}】"
+
+
 # ---------------------------------
 
 # Initialize Gemini for location analysis
 genai.configure(api_key=GEMINI_API_KEY)
 model_location = genai.GenerativeModel("gemini-2.5-flash")
+model_fallback = genai.GenerativeModel(GEMINI_FALLBACK_MODEL)
+
+
+def ask_gemini(prompt: str, deadline: Deadline, stage: str) -> str:
+    """Sends a prompt to Gemini within the deadline, hedged with the fallback model when it is slow."""
+    return hedged_call(
+        primary=lambda timeout: model_location.generate_content(prompt, request_options={"timeout": timeout}).text,
+        fallback=lambda timeout: model_fallback.generate_content(prompt, request_options={"timeout": timeout}).text,
+        deadline=deadline,
+        stage=stage,
+    ).strip()
 
 
 # ---------------------------------
@@ -53,7 +86,14 @@ class UserInfo:
     is_tone_selected: bool = False
     is_reels_provided: bool = False
     is_store_correct: bool = False
+    # Ranked store candidates extracted from reels_content, and the next one to show
+    store_candidates: List[Dict[str, str]] = field(default_factory=list)
+    candidate_index: int = 0
+    gemini_call_count: int = 0
+
 
+# Conversation-step fields a quick reply moves forward, rolled back when it times out
+FLOW_FIELDS = ("store_name", "is_tone_selected", "is_store_correct", "location_false_time", "candidate_index")
 
 USER_DATA_FILE = "user_data.json"
 user_data: Dict[str, UserInfo] = {}
@@ -86,7 +126,7 @@ def auto_save_user_data():
         time.sleep(30)  # Save every 30 seconds
         with open(USER_DATA_FILE, "w", encoding="utf-8") as user_data_file:
             json.dump({user_id: asdict(user) for user_id, user in user_data.items()}, user_data_file, indent=4)
-            print("✅ User data saved!")
+            print_status("✅ User data saved!")
 
 
 # Function to retrieve user data
@@ -94,26 +134,23 @@ def get_user_data(user_id: str) -> UserInfo:
     return user_data.get(user_id, None)
 
 
-threading.Thread(target=auto_save_user_data, daemon=True).start()
-
-# Load existing data on startup
-load_user_data()
+def start_user_data_service() -> None:
+    """
+        Loads user_data.json and starts the auto-save thread.
+        Only the webhook service calls this, so tools importing main (batch_process_reels.py, benchmarks)
+        never overwrite the live user data.
+    """
+    load_user_data()
+    threading.Thread(target=auto_save_user_data, daemon=True).start()
 
 
 # ---------------------------------
 # Functions
 
-def print_status(line: str, user_id: str | None = None) -> None:
-    if user_id is None:
-        print(line)
-    else:
-        print(f"{user_id}: \n{line}")
-
-
 def show_user_data(user_id: str) -> str:
     attrs = vars(get_user_data(user_id=user_id))
     text = ', '.join("%s: %s" % item for item in attrs.items())
-    print(attrs)
+    print_status(user_id=user_id, line=text)
     return text
 
 
@@ -138,6 +175,9 @@ def create_or_update_user_and_reel(user_id: str, reels_content: str | None) -> b
             user.is_tone_selected = False
             user.is_reels_provided = True
             user.is_store_correct = False
+            user.store_candidates = []
+            user.candidate_index = 0
+            user.gemini_call_count = 0
         print_status(user_id=user_id, line="User exist, resetting user info and updating reels_content.")
         return True
     else:
@@ -162,34 +202,27 @@ def delete_user_reel(user_id: str) -> None:
 
 
 # Gemini 分析地點功能
-def fetch_location_info_from_gemini(reels_content: str) -> (str, str):
-    """
-    使用 Gemini 分析 Reels 內容，提取店名與地址。
-    Returns:
-        store_name (str): 純店名，用於後續邏輯或儲存
-        message_to_ig (str): 顯示給使用者的完整訊息 (包含店名與地址確認)
-    """
-
-    def location_info_from_gemini(prmpt: str) -> str:
-        print_status(line="📡 呼叫 Gemini 取得地點資訊...")
-        response = model_location.generate_content(prmpt)
-        return response.text.strip()
+MAX_STORE_CANDIDATES = 3
+NO_STORE_MESSAGE = "Sorry, I couldn’t find any clear store information😢 If you’d like, I can try analyzing it again."
+STORE_FIELD_PATTERN = re.compile(r"【(Name|Address)】\s*[:：]\s*(.+)")
 
-    # 1. 修改 Prompt：要求同時輸出 Name 和 Address
-    prompt = f"""
+# Location prompt, split around the optional "rejected stores" rule and the reels content
+LOCATION_PROMPT_HEAD = f"""
     You are a professional restaurant information extractor. 
     Your task is to extract the **Restaurant Name** and **Address** from the provided text.
 
     **Extraction Rules:**
     1. Identify the specific name of the restaurant. Keep the original name if it helps with map search, but prefer English if available.
     2. Identify the address. **Translate the address into English** if it is in another language.
-    3. If the text contains a valid store name, output using the EXACT format below.
+    3. List up to {MAX_STORE_CANDIDATES} candidate stores, ranked from the most likely to the least likely, using the EXACT format below for each one.
     4. If NO store name is found, output exactly: NO_STORE_FOUND
     5. Language Requirement (MANDATORY)
         - Regardless of the language of the input text (Chinese, Japanese, etc.), the final output MUST be in ENGLISH.
         - Do not output any Chinese characters unless they are specific proper nouns (like a store name that has no English translation).
+    """
+LOCATION_PROMPT_TAIL = """
 
-    **Output Format:**
+    **Output Format (repeat for every candidate, most likely first):**
     【Name】: <Store Name Here>
     【Address】: <Address Here (in English, write "Unknown" if not mentioned)>
 
@@ -203,56 +236,116 @@ def fetch_location_info_from_gemini(reels_content: str) -> (str, str):
     Do NOT output extra explanations. Follow the format strictly.
 
     Below is the text:
-    {reels_content}
     """
-    
+
+
+def fetch_location_candidates_from_gemini(reels_content: str, excluded_names: List[str] | None = None,
+                                          deadline: Deadline | None = None) -> List[Dict[str, str]]:
+    """
+    使用 Gemini 分析 Reels 內容，一次提取多個候選店家（依可能性排序）。
+
+        :param reels_content: Reels 的文字內容
+        :param excluded_names: 使用者已否決的店名，請 Gemini 不要再提出
+        :param deadline: 這個事件剩下的時間預算
+
+        :return: [{"name": 店名, "address": 地址}, ...]，找不到時回傳空 list
+    """
+
+    def location_info_from_gemini(prmpt: str) -> str:
+        print_status(line="📡 呼叫 Gemini 取得地點資訊...")
+        return ask_gemini(prmpt, deadline or Deadline(EVENT_LATENCY_BUDGET), stage="fetch_location")
+
+    excluded_rule = ""
+    if excluded_names:
+        excluded_rule = ("6. The user already rejected these stores, do NOT output them again: "
+                         + ", ".join(excluded_names))
+
+    # 1. Prompt：要求一次輸出多個候選店家，每個都包含 Name 和 Address（模板在 module 載入時就建好）
+    prompt = LOCATION_PROMPT_HEAD + excluded_rule + LOCATION_PROMPT_TAIL + reels_content + "\n    "
+
     reply = location_info_from_gemini(prompt)
-    print(f"🤖 Gemini 回應:\n{reply}") 
-
-    # 2. 修改解析邏輯：同時抓取 Name 和 Address
-    name_match = re.search(r"【Name】\s*[:：]\s*(.+)", reply)
-    addr_match = re.search(r"【Address】\s*[:：]\s*(.+)", reply)
-
-    if name_match:
-        store_name = name_match.group(1).strip()
-        
-        # 如果有抓到地址就用，沒抓到就顯示未知
-        store_address = addr_match.group(1).strip() if addr_match else "未知"
-        if name_match:
-            store_name = name_match.group(1).strip()
-            
-            # 修改 1: 將 "未知" 改為 "Unknown"
-            store_address = addr_match.group(1).strip() if addr_match else "Unknown"
-            
-            # 修改 2: 將 "未提供詳細地址" 改為英文描述
-            if store_address.lower() == "unknown":
-                store_address = "Address details not provided"
-
-            # 組合顯示給使用者的訊息
-            display_message = (
-                f"📍 Name: {store_name}\n"
-                f"🗺️ Address: {store_address}\n\n"
-                f"Is this the location you were looking for?"
-            )
-        
-        # 返回 (存入資料庫用的店名, 顯示給使用者的訊息)
-        return store_name, display_message
-    else:
-        return "NO", "Sorry, I couldn’t find any clear store information😢 If you’d like, I can try analyzing it again."
+    print_status(line=f"🤖 Gemini 回應:\n{reply}")
+
+    # 2. 解析：每個【Name】開始一個新的候選，【Address】屬於前一個【Name】
+    candidates = []
+    for match in STORE_FIELD_PATTERN.finditer(reply):
+        label, value = match.group(1), match.group(2).strip()
+        if label == "Name":
+            candidates.append({"name": value, "address": "Unknown"})
+        elif candidates:
+            candidates[-1]["address"] = value
+
+    return candidates[:MAX_STORE_CANDIDATES]
+
+
+def format_store_candidate(candidate: Dict[str, str]) -> str:
+    """組合顯示給使用者的確認訊息"""
+    store_address = candidate["address"]
+    if store_address.lower() == "unknown":
+        store_address = "Address details not provided"
+
+    return (
+        f"📍 Name: {candidate['name']}\n"
+        f"🗺️ Address: {store_address}\n\n"
+        f"Is this the location you were looking for?"
+    )
+
+
+def call_gemini_for_user(user_id: str, gemini_func, *args, **kwargs):
+    """
+        Calls a Gemini-backed function and counts it in the user's current conversation.
+        Every Gemini call made for a user goes through here.
+
+        :param user_id: user the call is made for
+        :param gemini_func: is_food_related / fetch_location_candidates_from_gemini / generate_style_response
+        :return: whatever gemini_func returns
+    """
+    user = get_user_data(user_id)
+    if user is not None:
+        user.gemini_call_count += 1
+        print_status(user_id=user_id, line=f"Gemini calls in this conversation: {user.gemini_call_count}")
+    return gemini_func(*args, **kwargs)
+
+
+def next_store_candidate(user: UserInfo, deadline: Deadline | None = None) -> (str, str):
+    """
+    Show the next ranked candidate kept on the session.
+    Gemini is called again only when every stored candidate has been shown.
+
+        :param user: the current user
+        :param deadline: latency budget of the current event
+        :return: (store_name, message_to_ig), store_name is "NO" if nothing new was found
+    """
+    if user.candidate_index >= len(user.store_candidates):
+        shown_names = [candidate["name"] for candidate in user.store_candidates]
+        fresh_candidates = call_gemini_for_user(user.user_id, fetch_location_candidates_from_gemini,
+                                                user.reels_content, excluded_names=shown_names, deadline=deadline)
+
+        # 只保留還沒給使用者看過的候選（同一次回應裡重複的店名也只留一個）
+        seen_names = set(shown_names)
+        for candidate in fresh_candidates:
+            if candidate["name"] not in seen_names:
+                seen_names.add(candidate["name"])
+                user.store_candidates.append(candidate)
+
+        if user.candidate_index >= len(user.store_candidates):
+            return "NO", NO_STORE_MESSAGE
+
+    candidate = user.store_candidates[user.candidate_index]
+    user.candidate_index += 1
+    return candidate["name"], format_store_candidate(candidate)
 
 
 # User send a plain text
 def plain_text_flow(recipient_id, message_text) -> str | None:
-    print("plain_text_flow")
-    print(recipient_id, message_text)
+    print_status(user_id=recipient_id, line=f"plain_text_flow: {message_text}")
 
     return "Sorry, I only accept Reels content and quick-reply buttons!"
 
 
 # User respond a quick_reply
-def quick_reply_flow(recipient_id, msg_payload) -> str | None:
-    print("quick_reply_flow")
-    print(recipient_id, msg_payload)
+def quick_reply_flow(recipient_id, msg_payload, deadline: Deadline | None = None) -> str | None:
+    print_status(user_id=recipient_id, line=f"quick_reply_flow: {msg_payload}")
 
     current_user = get_user_data(recipient_id)
 
@@ -265,19 +358,22 @@ def quick_reply_flow(recipient_id, msg_payload) -> str | None:
             current_user.reels_content = ""
             current_user.store_name = ""
             current_user.is_reels_provided = False
+            current_user.store_candidates = []
+            current_user.candidate_index = 0
+            print_status(user_id=recipient_id, line=f"Conversation ended after {current_user.gemini_call_count} Gemini calls.")
             return "Thank you for using this service! Feel free to send me Reels anytime! 🌟"
 
         elif msg_payload == "FORCE_TREAT_AS_FOOD":
             current_user = get_user_data(recipient_id)
-            store_name, message_to_ig = fetch_location_info_from_gemini(current_user.reels_content)
+            store_name, message_to_ig = next_store_candidate(current_user, deadline)
 
             if store_name == "NO":
                 # 無法找到店名，改為顯示「再試一次」選項
-                send_ig_quick_reply(recipient_id, message_to_ig, ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"])
+                send_ig_quick_reply(recipient_id, message_to_ig, ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"], deadline=deadline)
             else:
                 # 正常流程
                 current_user.store_name = store_name
-                send_ig_quick_reply(recipient_id, message_to_ig, ["YES", "NO", "WANT_TO_END_DIALOG"])
+                send_ig_quick_reply(recipient_id, message_to_ig, ["YES", "NO", "WANT_TO_END_DIALOG"], deadline=deadline)
 
             return None
 
@@ -291,24 +387,25 @@ def quick_reply_flow(recipient_id, msg_payload) -> str | None:
             if current_user.location_false_time >= 2:
                 current_user.location_false_time = 0  # reset
                 message_to_ig = "Sorry, I still couldn’t extract the location😣\n\nPlease try re-uploading or provide a Reels with clearer details. Thank you!"
-                send_ig_quick_reply(recipient_id, message_to_ig, ["WANT_TO_END_DIALOG"])
+                send_ig_quick_reply(recipient_id, message_to_ig, ["WANT_TO_END_DIALOG"], deadline=deadline)
                 return None
 
-            # 否則再試一次 fetch
-            store_name, message_to_ig = fetch_location_info_from_gemini(current_user.reels_content)
+            # 否則換下一個候選店家（用完才會再呼叫 Gemini）
+            store_name, message_to_ig = next_store_candidate(current_user, deadline)
 
             if store_name == "NO":
                 short_message = "Sorry, I couldn’t find any clear store information😢 Do you want me to try analyzing it again?"
                 send_ig_quick_reply(
                     recipient_id,
                     short_message,
-                    ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"]
+                    ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"],
+                    deadline=deadline
                 )
 
             else:
                 # 終於找到了
                 current_user.store_name = store_name
-                send_ig_quick_reply(recipient_id, message_to_ig, ["YES", "NO", "WANT_TO_END_DIALOG"])
+                send_ig_quick_reply(recipient_id, message_to_ig, ["YES", "NO", "WANT_TO_END_DIALOG"], deadline=deadline)
 
             return None
 
@@ -318,11 +415,11 @@ def quick_reply_flow(recipient_id, msg_payload) -> str | None:
 
         # Want/need to change tone
         elif msg_payload == "WANT_TO_CHANGE_TONE" or not current_user.is_tone_selected:
-            let_user_change_tone(user_id=recipient_id)
+            let_user_change_tone(user_id=recipient_id, deadline=deadline)
 
         # Correct place is given by Gemini
         elif msg_payload == "YES":
-            print("✅ Gemini 風格回覆即將產生！")
+            print_status(user_id=recipient_id, line="✅ Gemini 風格回覆即將產生！")
             current_user.is_store_correct = True
 
         # Wrong place is given by Gemini
@@ -335,40 +432,41 @@ def quick_reply_flow(recipient_id, msg_payload) -> str | None:
 
             # Stor is correct (all set up) -> Generate response
             if current_user.is_store_correct:
-                styled_reply = generate_style_response(current_user.store_name, current_user.reels_content,
-                                                       current_user.tone_type)
+                styled_reply = call_gemini_for_user(recipient_id, generate_style_response,
+                                                    current_user.store_name, current_user.reels_content,
+                                                    current_user.tone_type, deadline=deadline)
                 if "請求次數已超過" in styled_reply:
-                    send_ig_message(recipient_id, styled_reply)
+                    send_ig_message(recipient_id, styled_reply, deadline=deadline)
                     return None
-                send_ig_message(recipient_id, styled_reply)
+                send_ig_message(recipient_id, styled_reply, deadline=deadline)
                 current_user.location_false_time = 0
                 # Tell user he/she can change tone
-                send_ig_message(recipient_id, f"📢 If you want to adjust the tone, please click 【{get_reply('WANT_TO_CHANGE_TONE')}】! 😊")
+                send_ig_message(recipient_id, CHANGE_TONE_HINT, deadline=deadline)
 
                 # Teach user how to end dialog
-                send_ig_quick_reply(recipient_id, f"⚠️ If you want to end the conversation, you can click 【{get_reply('WANT_TO_END_DIALOG')}】",
-                                    ['WANT_TO_CHANGE_TONE', 'WANT_TO_END_DIALOG'])
+                send_ig_quick_reply(recipient_id, END_DIALOG_HINT, ['WANT_TO_CHANGE_TONE', 'WANT_TO_END_DIALOG'], deadline=deadline)
 
             # Store is not correct -> fetch other information
             else:
                 if current_user.location_false_time < 3:
-                    # 先 fetch，再根據結果處理
-                    current_user.store_name, message_to_ig = fetch_location_info_from_gemini(current_user.reels_content)
+                    # 先取下一個候選店家（用完才會再呼叫 Gemini），再根據結果處理
+                    current_user.store_name, message_to_ig = next_store_candidate(current_user, deadline)
 
                     if current_user.store_name == "NO":
                         short_message = "Sorry, I couldn’t find any clear store information😢\n\nDo you want me to try analyzing it again?"
                         send_ig_quick_reply(
                             recipient_id,
                             short_message,
-                            ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"]
+                            ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"],
+                            deadline=deadline
                         )
                     else:
-                        send_ig_quick_reply(recipient_id, message_to_ig, ["YES", "NO", "WANT_TO_END_DIALOG"])
+                        send_ig_quick_reply(recipient_id, message_to_ig, ["YES", "NO", "WANT_TO_END_DIALOG"], deadline=deadline)
 
                 else:
                     message_to_ig = "Sorry, I couldn’t extract the location. Please try re-uploading or provide a Reels with more detailed information. Thank you!"
                     current_user.location_false_time = 0
-                    send_ig_quick_reply(recipient_id, message_to_ig, ["WANT_TO_END_DIALOG"])
+                    send_ig_quick_reply(recipient_id, message_to_ig, ["WANT_TO_END_DIALOG"], deadline=deadline)
 
             return None
 
@@ -378,8 +476,7 @@ def quick_reply_flow(recipient_id, msg_payload) -> str | None:
 
 
 # 檢查 reels_content 是否與食物相關
-def is_food_related(reels_content: str) -> bool:
-    prompt = f"""
+FOOD_CLASSIFIER_PROMPT = """
             You are a classifier specialized in detecting whether a text is related to food-related content.
 
             Please determine whether the following text is NOT related to “food recommendations or introductions.”
@@ -398,19 +495,25 @@ def is_food_related(reels_content: str) -> bool:
             Please reply with only “Yes” or “No,” without adding any additional text.
 
             Below is the text:
-            {reels_content}
             """
-    print("📡 呼叫 Gemini 進行食物分類判斷...")
-    response = model_location.generate_content(prompt)
-    result = response.text.strip().replace("。", "")
+
+
+def is_food_related(reels_content: str, deadline: Deadline | None = None) -> bool:
+    prompt = FOOD_CLASSIFIER_PROMPT + reels_content + "\n            "
+    print_status(line="📡 呼叫 Gemini 進行食物分類判斷...")
+    result = ask_gemini(prompt, deadline or Deadline(EVENT_LATENCY_BUDGET), stage="is_food_related").replace("。", "")
     return result == "Yes"
 
 
 
-def send_ig_message(recipient_id, reply_text):
-    url = f"https://graph.facebook.com/v21.0/me/messages?access_token={PAGE_ACCESS_TOKEN}"
-    headers = {"Content-Type": "application/json"}
+def graph_api_timeout(deadline: Deadline | None) -> float:
+    """Timeout of one Graph API call: what is left of the budget, but always enough to still send a reply."""
+    if deadline is None:
+        return GRAPH_API_TIMEOUT
+    return max(GRAPH_API_MIN_TIMEOUT, deadline.timeout(GRAPH_API_TIMEOUT))
 
+
+def send_ig_message(recipient_id, reply_text, deadline: Deadline | None = None):
     if len(reply_text) > 1900:
         reply_text = reply_text[:1900] + "...（訊息過長已截斷）"
 
@@ -419,20 +522,17 @@ def send_ig_message(recipient_id, reply_text):
         "message": {"text": reply_text},
         "messaging_type": "UPDATE"
     }
-    requests.post(url, json=payload, headers=headers)
+    try:
+        requests.post(GRAPH_API_URL, json=payload, headers=GRAPH_API_HEADERS, timeout=graph_api_timeout(deadline))
+    except requests.RequestException as e:
+        print_status(user_id=recipient_id, line=f"❌ 無法傳送訊息: {e}")
     # print("📤 發送狀態碼:", response.status_code)
     # print("📤 發送回應內容:", response.text)
 
 
-def send_ig_quick_reply(recipient_id, message_text, options):
-    url = f"https://graph.facebook.com/v21.0/me/messages?access_token={PAGE_ACCESS_TOKEN}"
-    headers = {"Content-Type": "application/json"}
-
-    quick_replies = [{
-        "content_type": "text",
-        "title": get_reply(option),
-        "payload": option
-    } for option in options]
+def send_ig_quick_reply(recipient_id, message_text, options, deadline: Deadline | None = None):
+    # Prebuilt payloads, unknown options still go through get_reply (and its error log)
+    quick_replies = [QUICK_REPLY_OPTIONS.get(option) or build_quick_reply_option(option) for option in options]
 
     payload = {
         "recipient": {"id": recipient_id},
@@ -444,22 +544,23 @@ def send_ig_quick_reply(recipient_id, message_text, options):
     }
 
     # response
-    requests.post(url, json=payload, headers=headers)
+    try:
+        requests.post(GRAPH_API_URL, json=payload, headers=GRAPH_API_HEADERS, timeout=graph_api_timeout(deadline))
+    except requests.RequestException as e:
+        print_status(user_id=recipient_id, line=f"❌ 無法傳送訊息: {e}")
     # print("📤 發送狀態碼:", response.status_code)
     # print("📤 發送回應內容:", response.text)
 
 
-def user_setups_are_all_set(user_id: str, message_text: str | None) -> bool:
-    create_or_update_user_and_reel(user_id=user_id, reels_content=message_text)
+def user_setups_are_all_set(user_id: str) -> bool:
     user = get_user_data(user_id=user_id)
 
     return user.is_reels_provided and user.is_tone_selected and user.is_store_correct
 
 
-def let_user_change_tone(user_id: str) -> None:
+def let_user_change_tone(user_id: str, deadline: Deadline | None = None) -> None:
     get_user_data(user_id=user_id).is_tone_selected = False
-    message_to_ig = "Which tone would you like me to use in future replies 🤖? \n\nPlease choose:" + "、".join(map(get_reply, VALID_TONES))
-    send_ig_quick_reply(user_id, message_to_ig, VALID_TONES + ["WANT_TO_END_DIALOG"])
+    send_ig_quick_reply(user_id, CHANGE_TONE_MESSAGE, TONE_OPTIONS, deadline=deadline)
 
 
 def change_tone(user_id: str, tone_type: str) -> None:
@@ -474,7 +575,138 @@ def change_tone(user_id: str, tone_type: str) -> None:
         print_status(user_id=user_id, line=f"⚠️ERROR: Unexpected error when changing tone!")
 
 
+def handle_messaging_events(data: dict, deadline: Deadline):
+    """
+        Handles the messaging events of one webhook POST.
+
+        :param data: JSON body sent by the Graph API
+        :param deadline: latency budget of this event, passed down to every stage
+    """
+    if "entry" in data:
+        for entry in data["entry"]:
+            for messaging_event in entry.get("messaging", []):
+                sender_id = messaging_event["sender"]["id"]
+
+                if "message" in messaging_event:
+
+                    if messaging_event["message"].get("is_echo", False):
+                        print_status(user_id=sender_id, line="Message from ourselves")
+                        continue
+
+                    # Got an attachment (might be a reel or a post)
+                    if "attachments" in messaging_event["message"]:
+                        print_status(user_id=sender_id, line="Got an attachment")
+
+                        for attachment in messaging_event["message"]["attachments"]:
+                            print_status(user_id=sender_id, line=f"🧩 Attachment type: {attachment['type']}")
+                            # Get a reel or post from user
+                            if attachment["type"] == "ig_reel":
+                                message_text = attachment["payload"].get("title", "(沒有標題)")
+
+                                # Save the reel first: a new reel starts a new conversation (and its Gemini count)
+                                create_or_update_user_and_reel(sender_id, reels_content=message_text)
+
+                                if not call_gemini_for_user(sender_id, is_food_related, message_text, deadline):
+                                    text = ("Sorry 😅！\n\nBased on my initial judgment, this Reels doesn’t seem to be food-related 🍽️, so I’m unable to retrieve store information.\n\nIf this is actually a food-related Reels, please click the button 【This is a food Reels】 and I’ll immediately help you find the store information! 🏃‍♂️💨")
+                                    send_ig_quick_reply(sender_id, text,
+                                                        ["FORCE_TREAT_AS_FOOD", "WANT_TO_END_DIALOG"], deadline=deadline)
+
+                                else:
+                                    # user_setups_are_all_set() ? True -> fetch location info and ask if the
+                                    # place is right
+                                    if user_setups_are_all_set(user_id=sender_id):
+                                        user = get_user_data(user_id=sender_id)
+                                        user.store_name, message_to_ig = next_store_candidate(user, deadline)
+                                        if user.store_name == "NO":
+                                            send_ig_quick_reply(sender_id, message_to_ig,
+                                                                ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"], deadline=deadline)
+
+                                        else:
+                                            send_ig_quick_reply(sender_id, message_to_ig,
+                                                                ["YES", "NO", "WANT_TO_END_DIALOG"], deadline=deadline)
+
+                                    # User didn't select the tone -> act as want to change tone
+                                    else:
+                                        let_user_change_tone(user_id=sender_id, deadline=deadline)
+
+                            else:
+                                reply_text = "⚠️Sorry, I’m currently unable to process IG posts or any content that isn’t a Reels～ Please try sending me another piece of content, and I’ll do my best to look it up for you! 📹💬"
+                                send_ig_message(recipient_id=sender_id, reply_text=reply_text, deadline=deadline)
+
+                    # User respond a quick reply
+                    elif "quick_reply" in messaging_event["message"]:
+                        quick_reply_payload = messaging_event["message"]["quick_reply"]["payload"]
+                        reply_text = quick_reply_flow(recipient_id=sender_id, msg_payload=quick_reply_payload,
+                                                     deadline=deadline)
+                        if reply_text is not None:
+                            send_ig_message(recipient_id=sender_id, reply_text=reply_text, deadline=deadline)
+                        return "OK", 200
+
+                    # Got plain text (No reels or posts included) -> may want to change tone or say yes/no to Gemini
+                    elif "text" in messaging_event["message"]:
+                        message_text = messaging_event["message"]["text"]
+                        reply_text = plain_text_flow(recipient_id=sender_id, message_text=message_text)
+                        send_ig_message(recipient_id=sender_id, reply_text=reply_text, deadline=deadline)
+                        send_ig_message(recipient_id=sender_id, reply_text="Please resend the Reels to start the conversation.", deadline=deadline)
+
+                    # Unexpected messaging_event (not reels, not posts, not plain text)
+                    else:
+                        reply_text = "⚠️ Unrecognized message type"
+                        send_ig_message(recipient_id=sender_id, reply_text=reply_text, deadline=deadline)
+
+                return "OK", 200
+
+    return "OK", 200
+
+
+def first_messaging_event(data: dict) -> dict | None:
+    for entry in data.get("entry", []):
+        for messaging_event in entry.get("messaging", []):
+            return messaging_event
+    return None
+
+
+def flow_state(user: UserInfo | None) -> Dict[str, object] | None:
+    if user is None:
+        return None
+    return {name: getattr(user, name) for name in FLOW_FIELDS}
+
+
+def reply_after_budget_exceeded(user_id: str, flow_before: Dict[str, object] | None, deadline: Deadline) -> None:
+    """
+        Tells the user we ran out of time (or Gemini failed), with quick replies that fit the session so they can retry.
+        The flow fields of a failed quick reply are rolled back first (e.g. YES already set is_store_correct,
+        NO already counted a wrong location). Gemini calls made and store candidates fetched are kept.
+
+        :param user_id: user_id (16-digit num)
+        :param flow_before: flow_state() before a quick reply was handled, None for other events
+        :param deadline: deadline of the event (once expired, the reply still gets GRAPH_API_MIN_TIMEOUT)
+    """
+    user = get_user_data(user_id)
+    if user is not None and flow_before is not None:
+        for name, value in flow_before.items():
+            setattr(user, name, value)
+
+    if user is None or not user.is_reels_provided:
+        send_ig_message(user_id, "⏱️ Sorry, this is taking longer than usual. Please send the Reels again in a moment!",
+                        deadline=deadline)
+        return
+
+    if not user.is_tone_selected:
+        options = TONE_OPTIONS
+    elif user.is_store_correct:
+        options = ["YES", "WANT_TO_CHANGE_TONE", "WANT_TO_END_DIALOG"]
+    elif user.store_name and user.store_name != "NO":
+        options = ["YES", "NO", "WANT_TO_END_DIALOG"]  # A candidate is shown and still waiting for an answer
+    else:
+        options = ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"]
+
+    send_ig_quick_reply(user_id, "⏱️ Sorry, this is taking longer than usual. Please tap a button to try again!", options,
+                        deadline=deadline)
+
+
 app = Flask(__name__)
+register_profiling_routes(app, get_user_data=lambda: user_data, get_chat=lambda: Gemini_tone_module.chat)
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -485,10 +717,10 @@ def webhook():
         challenge = request.args.get("hub.challenge")
 
         if mode == "subscribe" and token == VERIFY_TOKEN:
-            print("✅ 驗證成功！Webhook 已連接。")
+            print_status("✅ 驗證成功！Webhook 已連接。")
             return challenge, 200
         else:
-            print("❌ 驗證失敗。請確認 VERIFY_TOKEN 是否一致。")
+            print_status("❌ 驗證失敗。請確認 VERIFY_TOKEN 是否一致。", level=logging.WARNING)
             return "驗證失敗", 403
 
     elif request.method == "POST":
@@ -498,80 +730,31 @@ def webhook():
         # reply_text = ""
         # sender_id = None
 
-        if "entry" in data:
-            for entry in data["entry"]:
-                for messaging_event in entry.get("messaging", []):
-                    sender_id = messaging_event["sender"]["id"]
-
-                    if "message" in messaging_event:
-
-                        if messaging_event["message"].get("is_echo", False):
-                            print("Message from ourselves")
-                            continue
-
-                        # Got an attachment (might be a reel or a post)
-                        if "attachments" in messaging_event["message"]:
-                            print("Got an attachment")
-
-                            for attachment in messaging_event["message"]["attachments"]:
-                                print("🧩 Attachment type:", attachment["type"])  # 👈 加這行來 debug
-                                # Get a reel or post from user
-                                if attachment["type"] == "ig_reel":
-                                    message_text = attachment["payload"].get("title", "(沒有標題)")
-
-                                    if not is_food_related(message_text):
-                                        text = ("Sorry 😅！\n\nBased on my initial judgment, this Reels doesn’t seem to be food-related 🍽️, so I’m unable to retrieve store information.\n\nIf this is actually a food-related Reels, please click the button 【This is a food Reels】 and I’ll immediately help you find the store information! 🏃‍♂️💨")
-                                        create_or_update_user_and_reel(sender_id, reels_content=message_text)
-                                        send_ig_quick_reply(sender_id, text,
-                                                            ["FORCE_TREAT_AS_FOOD", "WANT_TO_END_DIALOG"])
-
-                                    else:
-                                        # Save the attachment info in the first place (user_setups_are_all_set()) is
-                                        # user_setups_are_all_set() ? True -> fetch location info and ask if the
-                                        # place is right
-                                        if user_setups_are_all_set(user_id=sender_id, message_text=message_text):
-                                            user = get_user_data(user_id=sender_id)
-                                            user.store_name, message_to_ig = fetch_location_info_from_gemini(
-                                                get_user_data(user_id=sender_id).reels_content)
-                                            if user.store_name == "NO":
-                                                send_ig_quick_reply(sender_id, message_to_ig,
-                                                                    ["TRY_AGAIN_LOCATION", "WANT_TO_END_DIALOG"])
-
-                                            else:
-                                                send_ig_quick_reply(sender_id, message_to_ig,
-                                                                    ["YES", "NO", "WANT_TO_END_DIALOG"])
-
-                                        # User didn't select the tone -> act as want to change tone
-                                        else:
-                                            let_user_change_tone(user_id=sender_id)
-
-                                else:
-                                    reply_text = "⚠️Sorry, I’m currently unable to process IG posts or any content that isn’t a Reels～ Please try sending me another piece of content, and I’ll do my best to look it up for you! 📹💬"
-                                    send_ig_message(recipient_id=sender_id, reply_text=reply_text)
-
-                        # User respond a quick reply
-                        elif "quick_reply" in messaging_event["message"]:
-                            quick_reply_payload = messaging_event["message"]["quick_reply"]["payload"]
-                            reply_text = quick_reply_flow(recipient_id=sender_id, msg_payload=quick_reply_payload)
-                            if reply_text is not None:
-                                send_ig_message(recipient_id=sender_id, reply_text=reply_text)
-                            return "OK", 200
+        deadline = Deadline(EVENT_LATENCY_BUDGET)
+        budget_exceeded = False
 
-                        # Got plain text (No reels or posts included) -> may want to change tone or say yes/no to Gemini
-                        elif "text" in messaging_event["message"]:
-                            message_text = messaging_event["message"]["text"]
-                            reply_text = plain_text_flow(recipient_id=sender_id, message_text=message_text)
-                            send_ig_message(recipient_id=sender_id, reply_text=reply_text)
-                            send_ig_message(recipient_id=sender_id, reply_text="Please resend the Reels to start the conversation.")
+        # Only the first messaging event is handled; keep its flow fields as they were, to roll back a timed-out quick reply
+        messaging_event = first_messaging_event(data)
+        sender_id = messaging_event["sender"]["id"] if messaging_event is not None else None
+        flow_before = None
+        if messaging_event is not None and "quick_reply" in messaging_event.get("message", {}):
+            flow_before = flow_state(get_user_data(sender_id))
 
-                        # Unexpected messaging_event (not reels, not posts, not plain text)
-                        else:
-                            reply_text = "⚠️ Unrecognized message type"
-                            send_ig_message(recipient_id=sender_id, reply_text=reply_text)
+        try:
+            return EVENT_PROFILER.call(handle_messaging_events, data, deadline)
 
-                    return "OK", 200
+        except (BudgetExceeded, GeminiUnavailable) as e:
+            # Out of time, or both models failed -> answer the user now with buttons to retry
+            budget_exceeded = isinstance(e, BudgetExceeded)
+            print_status(user_id=sender_id, line=f"⏱️ {e}")
+            if sender_id is not None:
+                reply_after_budget_exceeded(sender_id, flow_before, deadline)
+            return "OK", 200
 
-        return "OK", 200
+        finally:
+            # The summary copies and sorts the reply times, so only every LATENCY_SUMMARY_EVERY replies
+            if LATENCY_STATS.record_reply(deadline.elapsed(), budget_exceeded) % LATENCY_SUMMARY_EVERY == 0:
+                print_status(line=LATENCY_STATS.summary())
 
     # ✅ ADD THIS FINAL RETURN STATEMENT as a fallback
     return "Webhook endpoint reached.", 200
@@ -579,5 +762,6 @@ def webhook():
 
 if __name__ == "__main__":
     import os
+    start_user_data_service()
     port = int(os.environ.get("PORT", 5000))  # Render provides this
     app.run(host="0.0.0.0", port=port)
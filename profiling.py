@@ -0,0 +1,173 @@
+"""
+Opt-in memory and CPU profiling for the long-running webhook process.
+
+Only active when ENABLE_PROFILING=1 and PROFILING_TOKEN is set: tracemalloc is started and the /debug/* routes
+are registered.
+When it is off, the only cost is one attribute check per webhook event (EVENT_PROFILER.call).
+Every route needs ?token=<PROFILING_TOKEN>.
+
+    GET  /debug/memory?top=20        top allocation sites, and the growth since the previous call
+    GET  /debug/objects              UserInfo / BeautifulSoup object counts and Gemini chat history size
+    POST /debug/profile-next-event   profile the next webhook event with cProfile
+    GET  /debug/profile-last         result of the last profiled event (also dumped to PROFILE_DUMP_DIR)
+"""
+import cProfile
+import gc
+import hmac
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from collections import Counter
+from typing import Callable, Dict
+
+from flask import request, jsonify
+from status_log import print_status
+from constants import ENABLE_PROFILING, PROFILING_TOKEN, PROFILE_DUMP_DIR, TRACEMALLOC_FRAMES
+
+
+class EventProfiler:
+    """Runs the next webhook event under cProfile when armed, otherwise calls straight through."""
+
+    def __init__(self):
+        self.armed = False
+        self.last_result = "No event profiled yet."
+        self.profiled_events = 0
+        self._lock = threading.Lock()
+
+    def arm(self) -> None:
+        self.armed = True
+
+    def call(self, func: Callable, *args, **kwargs):
+        if not self.armed:
+            return func(*args, **kwargs)
+
+        with self._lock:
+            if not self.armed:  # Another request took it first
+                return func(*args, **kwargs)
+            self.armed = False
+            self.profiled_events += 1
+            event_number = self.profiled_events
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            self.last_result = self._dump(profiler, event_number)
+
+    @staticmethod
+    def _dump(profiler: cProfile.Profile, event_number: int) -> str:
+        os.makedirs(PROFILE_DUMP_DIR, exist_ok=True)
+        # Milliseconds plus a per-process counter, so events profiled in the same second don't overwrite each other
+        now = time.time()
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"-{int(now * 1000) % 1000:03d}"
+        dump_path = os.path.join(PROFILE_DUMP_DIR, f"event-{timestamp}-{event_number}.prof")
+        profiler.dump_stats(dump_path)
+
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(30)
+        print_status(f"📊 Webhook event profile saved to {dump_path}")
+        return f"Saved to {dump_path}\n{text.getvalue()}"
+
+
+EVENT_PROFILER = EventProfiler()
+_last_snapshot = None
+_snapshot_lock = threading.Lock()  # Concurrent reports must not compare against / replace the same snapshot
+
+
+def memory_report(top: int = 20) -> str:
+    """Top allocation sites, plus the biggest growth since the previous report."""
+    global _last_snapshot
+
+    if not tracemalloc.is_tracing():
+        return "tracemalloc is not running (set ENABLE_PROFILING=1)."
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced memory: current {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB",
+             "", f"Top {top} allocation sites:"]
+    lines += [str(stat) for stat in snapshot.statistics("lineno")[:top]]
+
+    with _snapshot_lock:
+        previous_snapshot, _last_snapshot = _last_snapshot, snapshot
+
+    if previous_snapshot is not None:
+        lines += ["", f"Top {top} growth since the previous report:"]
+        lines += [str(stat) for stat in snapshot.compare_to(previous_snapshot, "lineno")[:top]]
+
+    return "\n".join(lines)
+
+
+def chat_history_size(chat) -> Dict[str, int]:
+    history = getattr(chat, "history", [])
+    text_bytes = sum(len(getattr(part, "text", "").encode("utf-8"))
+                     for content in history for part in getattr(content, "parts", []))
+    return {"messages": len(history), "text_bytes": text_bytes}
+
+
+def object_report(get_user_data: Callable[[], dict], get_chat: Callable[[], object]) -> dict:
+    """Counts of the objects suspected of growing over time (walks the gc heap, so only on demand)."""
+    type_counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+    return {
+        "user_data_entries": len(get_user_data()),
+        "UserInfo_objects": type_counts["UserInfo"],
+        "BeautifulSoup_objects": type_counts["BeautifulSoup"],
+        "bs4_Tag_objects": type_counts["Tag"],
+        "gemini_chat_history": chat_history_size(get_chat()),
+        "gc_counts": gc.get_count(),
+    }
+
+
+def register_profiling_routes(app, get_user_data: Callable[[], dict], get_chat: Callable[[], object]) -> None:
+    """
+        Starts tracemalloc and adds the /debug/* routes, only if ENABLE_PROFILING and PROFILING_TOKEN are set.
+
+        :param app: the Flask app
+        :param get_user_data: returns the current user_data dict
+        :param get_chat: returns the Gemini chat session whose history is reported
+    """
+    if not ENABLE_PROFILING:
+        return
+    if not PROFILING_TOKEN:
+        print_status("⚠️ ENABLE_PROFILING is set but PROFILING_TOKEN is not, /debug/* routes stay disabled",
+                     level=logging.WARNING)
+        return
+
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    print_status("📊 Profiling enabled: tracemalloc started, /debug/* routes registered")
+
+    def authorized() -> bool:
+        # Constant-time comparison, so the token can't be guessed from response times (bytes: str must be ASCII)
+        return hmac.compare_digest(request.args.get("token", "").encode("utf-8"), PROFILING_TOKEN.encode("utf-8"))
+
+    @app.route("/debug/memory", methods=["GET"])
+    def debug_memory():
+        if not authorized():
+            return "Forbidden", 403
+        return memory_report(top=request.args.get("top", 20, type=int)), 200, {"Content-Type": "text/plain"}
+
+    @app.route("/debug/objects", methods=["GET"])
+    def debug_objects():
+        if not authorized():
+            return "Forbidden", 403
+        return jsonify(object_report(get_user_data, get_chat))
+
+    @app.route("/debug/profile-next-event", methods=["POST"])
+    def debug_profile_next_event():
+        if not authorized():
+            return "Forbidden", 403
+        EVENT_PROFILER.arm()
+        return "The next webhook event will be profiled.", 200
+
+    @app.route("/debug/profile-last", methods=["GET"])
+    def debug_profile_last():
+        if not authorized():
+            return "Forbidden", 403
+        return EVENT_PROFILER.last_result, 200, {"Content-Type": "text/plain"}
@@ -0,0 +1,51 @@
+"""
+Non-blocking status logging shared by the service modules.
+
+print_status only puts a LogRecord on a queue (QueueHandler); a QueueListener thread formats it and writes it to
+stdout, so a slow stdout (a full pipe, a log collector that stalls) never holds up a webhook request.
+Lines are structured: time, level, thread and user_id, then the message.
+
+    2026-10-19 11:14:38 INFO Thread-3 user_id=1234567890123456 ✅ User-selected tone:ASK_TO_USE_MEME_TONE
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+from constants import LOG_LEVEL
+
+# Not used in the format, so don't collect them for every record
+logging.logMultiprocessing = False
+logging.logProcesses = False
+logging._srcfile = None  # Skips the stack walk that finds the caller's file and line number
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(threadName)s user_id=%(user_id)s %(message)s"
+
+
+class DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting to the listener thread (our messages are built before logging)."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+log_queue = queue.SimpleQueue()
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt="%Y-%m-%d %H:%M:%S", defaults={"user_id": "-"}))
+listener = logging.handlers.QueueListener(log_queue, stdout_handler)
+
+logger = logging.getLogger("reels_bot")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(DeferredFormatQueueHandler(log_queue))
+logger.propagate = False
+
+listener.start()
+atexit.register(listener.stop)  # Writes out what is still queued before the interpreter shuts down
+
+
+def print_status(line: str, user_id: str | None = None, level: int = logging.INFO) -> None:
+    if user_id is None:
+        logger.log(level, line)
+    else:
+        logger.log(level, line, extra={"user_id": user_id})